@@ -0,0 +1,92 @@
+# framing.py
+# MIDI event framing on the wire and in the receive ringbuffer, and ringbuffer record access
+import struct
+
+import mido
+
+# MIDI events are sent, and stored in the ringbuffer, prefixed with their length
+# and their frame offset within the period
+MIDI_EVENT_HEADER = struct.Struct('!BH')
+MAX_MIDI_EVENT_SIZE = 255
+
+
+def peek_ringbuffer(rb, view: memoryview, nbytes: int) -> None:
+    """Copy `nbytes` from a jack.RingBuffer into `view` without consuming them.
+
+    The caller must have checked that `rb.read_space` is at least `nbytes`.
+    Copies straight out of the ringbuffer's memory, which may wrap around its
+    end, instead of letting RingBuffer.read() allocate a new buffer.
+    """
+    first, second = rb.read_buffers
+    head = min(len(first), nbytes)
+    view[:head] = memoryview(first)[:head]
+    view[head:nbytes] = memoryview(second)[:nbytes - head]
+
+
+def read_ringbuffer(rb, view: memoryview, nbytes: int) -> None:
+    """Like `peek_ringbuffer()`, but consumes the bytes."""
+    peek_ringbuffer(rb, view, nbytes)
+    rb.read_advance(nbytes)
+
+
+def read_midi_event(rb, view: memoryview):
+    """Read one MIDI event record from a jack.RingBuffer into `view`.
+
+    Returns (offset, length) of the event, or None if no complete record is
+    readable yet. The writer's pointer may become visible in two steps when a
+    write wraps around the end of the ringbuffer, so a record is only consumed
+    once all of it can be read.
+    """
+    if rb.read_space < MIDI_EVENT_HEADER.size:
+        return None
+    peek_ringbuffer(rb, view, MIDI_EVENT_HEADER.size)
+    length, offset = MIDI_EVENT_HEADER.unpack_from(view)
+    if rb.read_space < MIDI_EVENT_HEADER.size + length:
+        return None
+
+    rb.read_advance(MIDI_EVENT_HEADER.size)
+    read_ringbuffer(rb, view, length)
+    return offset, length
+
+
+def pack_midi_events(events, packet: memoryview, send) -> None:
+    """Pack (offset, data) MIDI events into as few datagrams as possible.
+
+    Each datagram is built in `packet`, and `send(size)` is called whenever it
+    is full and once at the end. Events that cannot be framed (very long SysEx)
+    are skipped.
+    """
+    size = 0
+    for offset, data in events:
+        length = len(data)
+        if length > MAX_MIDI_EVENT_SIZE:
+            continue
+        if size + MIDI_EVENT_HEADER.size + length > len(packet):
+            send(size)
+            size = 0
+        MIDI_EVENT_HEADER.pack_into(packet, size, length, offset)
+        size += MIDI_EVENT_HEADER.size
+        packet[size:size + length] = data
+        size += length
+
+    if size:
+        send(size)
+
+
+def unpack_midi_events(datagram):
+    """Yield a record for every MIDI message in a datagram built by `pack_midi_events()`.
+
+    Records are framed with MIDI_EVENT_HEADER, ready for the ringbuffer. Parsing
+    with mido drops malformed bytes.
+    """
+    pos = 0
+    while pos + MIDI_EVENT_HEADER.size <= len(datagram):
+        length, offset = MIDI_EVENT_HEADER.unpack_from(datagram, pos)
+        pos += MIDI_EVENT_HEADER.size
+        event = datagram[pos:pos + length]
+        pos += length
+
+        for msg in mido.parse_all(event):
+            midi_bytes = bytes(msg.bytes())
+            if len(midi_bytes) <= MAX_MIDI_EVENT_SIZE:
+                yield MIDI_EVENT_HEADER.pack(len(midi_bytes), offset) + midi_bytes
@@ -1,10 +1,18 @@
+import gc
 import toml
-import time
 import threading
 import argparse
 import os
 from .lib import MidiTransmitter, MidiReceiver, AudioTransmitter, AudioReceiver
 
+# Client classes by the 'type' value used in the configuration file
+CLIENT_TYPES = {
+    'MidiTransmitter': MidiTransmitter,
+    'MidiReceiver': MidiReceiver,
+    'AudioTransmitter': AudioTransmitter,
+    'AudioReceiver': AudioReceiver,
+}
+
 
 class Manager:
 
@@ -34,23 +42,21 @@ class Manager:
                 values.get('buffer_size', None)  # Assuming buffer_size might be optional
             )
 
-            if client_type == 'MidiTransmitter':
-                self.clients[client_and_port] = MidiTransmitter(*common_args)
-            elif client_type == 'MidiReceiver':
-                self.clients[client_and_port] = MidiReceiver(*common_args)
-            elif client_type == 'AudioTransmitter':
-                self.clients[client_and_port] = AudioTransmitter(*common_args)
-            elif client_type == 'AudioReceiver':
-                self.clients[client_and_port] = AudioReceiver(*common_args)
-            else:
+            client_class = CLIENT_TYPES.get(client_type)
+            if client_class is None:
                 print(f"Warning: Unknown client type '{client_type}' for {client_and_port}. Skipping...")
+                continue
 
+            self.clients[client_and_port] = client_class(*common_args, pin_to_numa_node=values.get('pin_to_numa_node', False))
             self.clients[client_and_port].stop_event = self.stop_event
 
         return self.clients
 
     def start_clients(self):
         self.load_config()
+        # Move everything allocated during setup out of the collector's reach,
+        # so collections triggered on the JACK realtime threads stay short
+        gc.freeze()
         for name, client in self.clients.items():
             t = threading.Thread(target=self.worker, args=(client,))
             t.start()
@@ -67,8 +73,7 @@ class Manager:
     def run(self):
         try:
             self.start_clients()
-            while not self.stop_event.is_set():  # Loop until the stop_event is set
-                time.sleep(1)
+            self.stop_event.wait()  # Block until the stop_event is set
         except KeyboardInterrupt:
             print("Terminating clients...")
             self.terminate_clients()
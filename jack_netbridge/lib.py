@@ -2,19 +2,38 @@
 from abc import ABC, abstractmethod
 import socket
 import struct
+import errno
 import fcntl
+import os
+import sys
 
 import threading
-import queue
-import time
 
 import jack
-import mido
 import numpy as np
 
+from .framing import MAX_MIDI_EVENT_SIZE, read_ringbuffer, read_midi_event, pack_midi_events, unpack_midi_events
+from .mmsg import BatchedMulticastSender, BatchedMulticastReceiver, PeriodReassembler, MAX_DATAGRAM_SIZE, MAX_PAYLOAD_SIZE, SEGMENT_HEADER
+
 DEFAULT_MULTICAST_TTL = 2
 DEFAULT_MULTICAST_PORT = 4000
 DEFAULT_BUFFER_SIZE = 1024
+# Number of JACK periods of data the receive ringbuffers can hold
+RINGBUFFER_PERIODS = 8
+# Ringbuffer space per frame of MIDI: a three byte message and its record header
+MIDI_BYTES_PER_FRAME = 6
+# Socket buffer sizes requested from the kernel (capped by net.core.rmem_max / wmem_max)
+RECEIVE_SOCKET_BUFFER_SIZE = 8 * 1024 * 1024
+SEND_SOCKET_BUFFER_SIZE = 4 * 1024 * 1024
+# Linux path MTU discovery: never fragment, reject sends larger than the MTU instead
+IP_MTU_DISCOVER = getattr(socket, 'IP_MTU_DISCOVER', 10)
+IP_PMTUDISC_DO = getattr(socket, 'IP_PMTUDISC_DO', 2)
+# IPv4 and UDP headers, which count against the interface MTU
+IP_UDP_HEADER_SIZE = 28
+# Audio is sent as 16 bit signed integer samples
+WIRE_SAMPLE_DTYPE = np.int16
+WIRE_SAMPLE_WIDTH = 2
+WIRE_SAMPLE_SCALE = 32768.0
 
 
 class NetworkingSettingsHandler:
@@ -53,21 +72,106 @@ class NetworkingSettingsHandler:
             # Handle any IO exceptions (like interface not found)
             return None
 
+    @staticmethod
+    def get_mtu_by_interface_name(ifname):
+        """Resolve an interface's name to its MTU.
+
+        Example: eth0 -> 1500
+        """
+
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+        try:
+            # struct ifreq: the interface name, followed by the MTU as an int
+            packed_ifname = struct.pack('16si', ifname[:15].encode('utf-8'), 0)
+
+            # SIOCGIFMTU (0x8921) is the command to get the MTU
+            ioctl_result = fcntl.ioctl(s.fileno(), 0x8921, packed_ifname)
+
+            return struct.unpack_from('i', ioctl_result, 16)[0]
+
+        except IOError:
+            return None
+
+        finally:
+            s.close()
+
+    @staticmethod
+    def get_numa_cpus_by_interface_name(ifname):
+        """Resolve an interface's name to the CPUs of the NUMA node its device is attached to.
+
+        Example: eth0 -> {0, 1, 2, 3}
+        Returns None if the interface is not bound to a NUMA node.
+        """
+
+        try:
+            with open(f"/sys/class/net/{ifname}/device/numa_node") as f:
+                numa_node = int(f.read())
+
+            # -1 means the device has no NUMA affinity (e.g. single node systems)
+            if numa_node < 0:
+                return None
+
+            with open(f"/sys/devices/system/node/node{numa_node}/cpulist") as f:
+                cpulist = f.read().strip()
+
+            # Memory-only nodes (e.g. CXL memory) have no CPUs
+            if not cpulist:
+                return None
+
+            # The CPU list looks like "0-7,16-23"
+            cpus = set()
+            for cpu_range in cpulist.split(','):
+                first, _, last = cpu_range.partition('-')
+                cpus.update(range(int(first), int(last or first) + 1))
+            return cpus
+
+        except (OSError, ValueError):
+            # Virtual interfaces have no device, non-Linux systems have no sysfs
+            return None
+
 
 class BaseJackNetworkBridge(ABC):
 
     def __init__(self, jack_client_name, jack_port_name: str):
         self.jack_port_name = jack_port_name
         self.jack_client_name = jack_client_name
+        self.interface_name = None
+        self.pin_to_numa_node = False
         self.stop_event = None
 
+    def pin_to_interface_numa_node(self) -> None:
+        # Keep the calling thread on the NUMA node that owns the network interface,
+        # so packet data does not cross sockets. Threads it creates inherit this.
+        # Opt-in, as it overrides the affinity of the calling thread.
+        if not self.pin_to_numa_node or not hasattr(os, 'sched_setaffinity'):
+            return
+        cpus = NetworkingSettingsHandler.get_numa_cpus_by_interface_name(self.interface_name)
+        if not cpus:
+            return
+
+        # Stay within the CPUs we may run on (taskset, cpusets, containers)
+        cpus &= os.sched_getaffinity(0)
+        if not cpus:
+            return
+        try:
+            os.sched_setaffinity(0, cpus)
+        except OSError:
+            # Pinning is an optimization; keep running unpinned
+            pass
+
     def start(self):
+        # The JACK process thread is created on activation and inherits the affinity
+        self.pin_to_interface_numa_node()
         with self.client:
             print("JACK client activated:", self.jack_client_name)
-            while True:
-                time.sleep(1)
-                if self.stop_event.is_set():
-                    break
+            self.stop_event.wait()
+        self.print_statistics()
+
+    def print_statistics(self) -> None:
+        # Realtime paths only count events; anything worth printing is printed here,
+        # after the client has been deactivated
+        pass
 
 class BaseReceiver(BaseJackNetworkBridge):
 
@@ -78,15 +182,25 @@ class BaseReceiver(BaseJackNetworkBridge):
                  interface_name: str,
                  multicast_ttl: int = DEFAULT_MULTICAST_TTL,
                  multicast_port: int = DEFAULT_MULTICAST_PORT,
-                 buffer_size: int = 0
+                 buffer_size: int = 0,
+                 pin_to_numa_node: bool = False
                  ):
         super().__init__(jack_client_name, jack_port_name)
         self.multicast_group = multicast_group
+        self.interface_name = interface_name
+        self.pin_to_numa_node = pin_to_numa_node
         self.interface_ip = NetworkingSettingsHandler.get_ip_address_by_interface_name(interface_name)
         self.multicast_ttl = multicast_ttl
         self.multicast_port = multicast_port
         self.buffer_size = buffer_size
-        self.queue = queue.Queue()
+        self.rb = None
+        # Data dropped because the ringbuffer was full (listener thread) or the
+        # JACK port was full (process thread). Each thread only updates its own
+        # counter, as += on a shared one is not atomic.
+        self.ringbuffer_overruns = 0
+        self.port_overruns = 0
+        # Periods played as silence because no data had arrived
+        self.underruns = 0
         self.setup_multicast_socket()
         self.listener_thread = threading.Thread(target=self.listen_multicast)
 
@@ -96,6 +210,11 @@ class BaseReceiver(BaseJackNetworkBridge):
 
         # Allow multiple sockets to use the same PORT number
         self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if hasattr(socket, 'SO_REUSEPORT'):
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+
+        # Enlarge the receive buffer so bursts at period boundaries are not dropped
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RECEIVE_SOCKET_BUFFER_SIZE)
 
         # Bind the socket to the specified multicast group IP and port
         self.sock.bind((self.multicast_group, self.multicast_port))
@@ -109,6 +228,30 @@ class BaseReceiver(BaseJackNetworkBridge):
         # Set a timeout on blocking socket operations (in seconds)
         self.sock.settimeout(1)
 
+    def setup_ringbuffer(self, period_size: int):
+        # Lock-free single-producer/single-consumer buffer between the network
+        # listener thread and the JACK process callback, for RINGBUFFER_PERIODS
+        # periods of `period_size` bytes. Must be called once the JACK block
+        # size is known. JACK always keeps one byte of the buffer free.
+        self.rb = jack.RingBuffer(period_size * RINGBUFFER_PERIODS + 1)
+        try:
+            # Keep the buffer from being paged out under the process callback
+            self.rb.mlock()
+        except jack.JackError:
+            # Not permitted by RLIMIT_MEMLOCK; the ringbuffer works without it
+            pass
+
+    def push_to_ringbuffer(self, data) -> bool:
+        # Write the whole datagram or nothing: partial writes would misalign the stream
+        if self.rb.write_space < len(data):
+            self.ringbuffer_overruns += 1
+            return False
+        self.rb.write(data)
+        return True
+
+    def print_statistics(self) -> None:
+        print(f"JACK client deactivated: {self.jack_client_name} ({self.ringbuffer_overruns + self.port_overruns} overruns, {self.underruns} underruns)")
+
     @abstractmethod
     def listen_multicast(self):
         raise NotImplemented("This method must be implemented in a subclass!")
@@ -122,16 +265,20 @@ class BaseTransmitter(BaseJackNetworkBridge):
                  interface_name: str,
                  multicast_ttl: int = DEFAULT_MULTICAST_TTL,
                  multicast_port: int = DEFAULT_MULTICAST_PORT,
-                 buffer_size: int = 0):
+                 buffer_size: int = 0,
+                 pin_to_numa_node: bool = False):
         super().__init__(jack_client_name, jack_port_name)
         self.multicast_group = multicast_group
+        self.interface_name = interface_name
+        self.pin_to_numa_node = pin_to_numa_node
         self.interface_ip = NetworkingSettingsHandler.get_ip_address_by_interface_name(interface_name)
         self.multicast_ttl = multicast_ttl
         self.multicast_port = multicast_port
         self.buffer_size = buffer_size
         if self.buffer_size == 0:
             self.buffer_size = 1024
-        self.buffer = bytearray()
+        # Sends the kernel rejected, e.g. because the interface MTU shrank
+        self.send_errors = 0
         self.setup_multicast_socket()
 
     def setup_multicast_socket(self):
@@ -144,11 +291,36 @@ class BaseTransmitter(BaseJackNetworkBridge):
         # Set the time-to-live (TTL) for multicast. This determines how many network hops the packet will take before being discarded
         self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, struct.pack('b', self.multicast_ttl))
 
+        # Enlarge the send buffer so a whole batch of datagrams fits in the kernel at once
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SEND_SOCKET_BUFFER_SIZE)
+
+        # Size datagrams to fit the interface MTU, so they never need IP fragmentation
+        mtu = NetworkingSettingsHandler.get_mtu_by_interface_name(self.interface_name)
+        self.payload_size = MAX_PAYLOAD_SIZE
+        if mtu is not None:
+            self.payload_size = max(1, min(MAX_PAYLOAD_SIZE, mtu - IP_UDP_HEADER_SIZE - SEGMENT_HEADER.size))
+
+        # Reject datagrams that do not fit the MTU instead of fragmenting them
+        if sys.platform.startswith('linux'):
+            self.sock.setsockopt(socket.IPPROTO_IP, IP_MTU_DISCOVER, IP_PMTUDISC_DO)
+
         # Bind the socket to the specific interface IP address and an ephemeral port (port 0 lets the OS choose an available port)
         self.sock.bind((self.interface_ip, 0))
 
+        self.sender = BatchedMulticastSender(self.sock, (self.multicast_group, self.multicast_port), self.payload_size)
+
     def send_multicast(self, data: bytes):
-        self.sock.sendto(data, (self.multicast_group, self.multicast_port))
+        # Split into MTU sized segments the receiver reassembles
+        try:
+            self.sender.send_segmented(data)
+        except OSError as e:
+            # Count it instead of raising on the realtime thread
+            if e.errno != errno.EMSGSIZE:
+                raise
+            self.send_errors += 1
+
+    def print_statistics(self) -> None:
+        print(f"JACK client deactivated: {self.jack_client_name} ({self.send_errors} send errors)")
 
 class MidiReceiver(BaseReceiver):
     def __init__(self,
@@ -158,12 +330,13 @@ class MidiReceiver(BaseReceiver):
                  interface_name: str,
                  multicast_ttl: int = DEFAULT_MULTICAST_TTL,
                  multicast_port: int = DEFAULT_MULTICAST_PORT,
-                 buffer_size: int = None
+                 buffer_size: int = None,
+                 pin_to_numa_node: bool = False
                  ) -> None:
-        super().__init__(jack_client_name, jack_port_name, multicast_group, interface_name, multicast_ttl, multicast_port, buffer_size)
+        super().__init__(jack_client_name, jack_port_name, multicast_group, interface_name, multicast_ttl, multicast_port, buffer_size, pin_to_numa_node)
 
-        self.midi_queue = queue.Queue()
         self.setup_jack()
+        self.setup_ringbuffer(self.buffer_size * MIDI_BYTES_PER_FRAME)
 
         self.listener_thread.start()
 
@@ -176,25 +349,44 @@ class MidiReceiver(BaseReceiver):
         self.buffer_size = self.client.blocksize
         self.port_handle = self.client.midi_outports.register(self.jack_port_name)
 
+        # Buffer for a single ringbuffer record, reused every period
+        self.midi_data = bytearray(MAX_MIDI_EVENT_SIZE)
+        self.midi_view = memoryview(self.midi_data)
+
         self.client.set_process_callback(self.process_callback)
 
     def process_callback(self, frames: int) -> None:
         self.port_handle.clear_buffer()
-        while not self.midi_queue.empty():
-            midi_data = self.midi_queue.get_nowait()
-            msg = mido.parse_all(midi_data)
-            for m in msg:
-                self.port_handle.write_midi_event(0, m.bytes())
+        # JACK refuses events that are not sorted by time, and the ringbuffer
+        # may hold the events of more than one transmitter period
+        last_time = 0
+        while True:
+            # An incomplete record is left for the next cycle
+            event = read_midi_event(self.rb, self.midi_view)
+            if event is None:
+                break
+            offset, length = event
+            last_time = min(max(offset, last_time), frames - 1)
+            try:
+                self.port_handle.write_midi_event(last_time, self.midi_view[:length])
+            except jack.JackError:
+                # Port buffer full; count it instead of raising on the realtime thread
+                self.port_overruns += 1
 
 
     def listen_multicast(self) -> None:
+        self.pin_to_interface_numa_node()
+        receiver = BatchedMulticastReceiver(self.sock, MAX_PAYLOAD_SIZE)
         while True:
             if self.stop_event is not None and self.stop_event.is_set():
                 break
             try:
-                data, addr = self.sock.recvfrom(64)
-                self.midi_queue.put(data)
-            except Exception as e:
+                for data in receiver.recv():
+                    # Parse here rather than in the process callback
+                    for record in unpack_midi_events(data):
+                        self.push_to_ringbuffer(record)
+            except socket.timeout:
+                # Nothing received; check the stop event again
                 pass
 
 
@@ -206,9 +398,10 @@ class MidiTransmitter(BaseTransmitter):
                  interface_name: str,
                  multicast_ttl: int = DEFAULT_MULTICAST_TTL,
                  multicast_port: int = DEFAULT_MULTICAST_PORT,
-                 buffer_size: int = None
+                 buffer_size: int = None,
+                 pin_to_numa_node: bool = False
                  ) -> None:
-        super().__init__(jack_client_name, jack_port_name, multicast_group, interface_name, multicast_ttl, multicast_port, buffer_size)
+        super().__init__(jack_client_name, jack_port_name, multicast_group, interface_name, multicast_ttl, multicast_port, buffer_size, pin_to_numa_node)
 
         self.setup_jack()
 
@@ -220,11 +413,26 @@ class MidiTransmitter(BaseTransmitter):
 
         self.buffer_size = self.client.blocksize
         self.port_handle = self.client.midi_inports.register(self.jack_port_name)
+
+        # Datagram buffer reused every period, sized to fit the interface MTU
+        self.packet = bytearray(self.payload_size)
+        self.packet_view = memoryview(self.packet)
+
         self.client.set_process_callback(self.process_callback)
 
+    def send_packet(self, size: int) -> None:
+        self.sender.queue(self.packet_view[:size])
+        try:
+            self.sender.flush()
+        except OSError as e:
+            # Count it instead of raising on the realtime thread
+            if e.errno != errno.EMSGSIZE:
+                raise
+            self.send_errors += 1
+
     def process_callback(self, frames: int) -> None:
-        for offset, data in self.port_handle.incoming_midi_events():
-            self.send_multicast(data)
+        # Coalesce all events of the period into as few datagrams as possible
+        pack_midi_events(self.port_handle.incoming_midi_events(), self.packet_view, self.send_packet)
 
 class AudioReceiver(BaseReceiver):
 
@@ -235,10 +443,12 @@ class AudioReceiver(BaseReceiver):
                  interface_name: str,
                  multicast_ttl: int = DEFAULT_MULTICAST_TTL,
                  multicast_port: int = DEFAULT_MULTICAST_PORT,
-                 buffer_size: int = 0) -> None:
-        super().__init__(jack_client_name, jack_port_name, multicast_group, interface_name, multicast_ttl, multicast_port, buffer_size)
+                 buffer_size: int = 0,
+                 pin_to_numa_node: bool = False) -> None:
+        super().__init__(jack_client_name, jack_port_name, multicast_group, interface_name, multicast_ttl, multicast_port, buffer_size, pin_to_numa_node)
 
         self.setup_jack()
+        self.setup_ringbuffer(self.buffer_size * WIRE_SAMPLE_WIDTH)
         self.listener_thread.start()
 
     def setup_jack(self) -> None:
@@ -249,21 +459,50 @@ class AudioReceiver(BaseReceiver):
         self.buffer_size = self.client.blocksize
         self.output_port = self.client.outports.register(self.jack_port_name)
 
+        # Receive buffer reused every period, with an int16 view on it
+        self.audio_data = bytearray(self.buffer_size * WIRE_SAMPLE_WIDTH)
+        self.audio_view = memoryview(self.audio_data)
+        self.audio_samples = np.frombuffer(self.audio_data, dtype=WIRE_SAMPLE_DTYPE)
+
         self.client.set_process_callback(self.process_callback)
 
     def process_callback(self, frames: int) -> None:
-        if not self.queue.empty():
-            audio_data = self.queue.get_nowait()
-            self.output_port.get_buffer()[:] = np.fromstring(audio_data, dtype=np.float32)
+        nbytes = frames * WIRE_SAMPLE_WIDTH
+        if self.rb.read_space >= nbytes:
+            first, second = self.rb.read_buffers
+            contiguous = len(first) >= nbytes
+            if contiguous:
+                # Use a view on the ringbuffer's memory, no copy needed
+                samples = np.frombuffer(first, dtype=WIRE_SAMPLE_DTYPE, count=frames)
+            else:
+                # The period wraps around the end of the ringbuffer, gather it first
+                read_ringbuffer(self.rb, self.audio_view, nbytes)
+                samples = self.audio_samples[:frames]
+
+            # The port buffer has to be fetched in every cycle, it must not be cached.
+            # Dequantize directly into it.
+            np.multiply(samples, np.float32(1.0 / WIRE_SAMPLE_SCALE), out=self.output_port.get_array())
+            if contiguous:
+                self.rb.read_advance(nbytes)
+        else:
+            # Underrun: output silence rather than whatever the port buffer held
+            self.output_port.get_array().fill(0.0)
+            self.underruns += 1
 
     def listen_multicast(self) -> None:
+        self.pin_to_interface_numa_node()
+        receiver = BatchedMulticastReceiver(self.sock, MAX_DATAGRAM_SIZE)
+        reassembler = PeriodReassembler(self.buffer_size * WIRE_SAMPLE_WIDTH)
         while True:
             if self.stop_event is not None and self.stop_event.is_set():
                 break
             try:
-                data, addr = self.sock.recvfrom(self.buffer_size * 4) # 4 because of float32
-                self.queue.put(data)
-            except Exception as e:
+                for data in receiver.recv():
+                    # Only complete periods go to the ringbuffer
+                    if reassembler.add(data):
+                        self.push_to_ringbuffer(reassembler.period_data)
+            except socket.timeout:
+                # Nothing received; check the stop event again
                 pass
 
 class AudioTransmitter(BaseTransmitter):
@@ -275,8 +514,9 @@ class AudioTransmitter(BaseTransmitter):
                  interface_name: str,
                  multicast_ttl: int = DEFAULT_MULTICAST_TTL,
                  multicast_port: int = DEFAULT_MULTICAST_PORT,
-                 buffer_size: int = 0) -> None:
-        super().__init__(jack_client_name, jack_port_name, multicast_group, interface_name, multicast_ttl, multicast_port, buffer_size)
+                 buffer_size: int = 0,
+                 pin_to_numa_node: bool = False) -> None:
+        super().__init__(jack_client_name, jack_port_name, multicast_group, interface_name, multicast_ttl, multicast_port, buffer_size, pin_to_numa_node)
         self.setup_jack()
 
     def setup_jack(self) -> None:
@@ -286,10 +526,19 @@ class AudioTransmitter(BaseTransmitter):
 
         self.buffer_size = self.client.blocksize
         self.input_port = self.client.inports.register(self.jack_port_name)
+
+        # Quantization buffers reused every period
+        self.scaled_samples = np.empty(self.buffer_size, dtype=np.float32)
+        self.wire_samples = np.empty(self.buffer_size, dtype=WIRE_SAMPLE_DTYPE)
+
         self.client.set_process_callback(self.process_callback)
 
     def process_callback(self, frames: int) -> None:
-        self.buffer.extend(self.input_port.get_array().tobytes())
-        if len(self.buffer) >= self.buffer_size:
-            self.send_multicast(self.buffer)
-            self.buffer.clear()
+        # Quantize to int16 in place, then send
+        scaled = self.scaled_samples[:frames]
+        wire = self.wire_samples[:frames]
+        np.multiply(self.input_port.get_array(), WIRE_SAMPLE_SCALE, out=scaled)
+        np.rint(scaled, out=scaled)
+        np.clip(scaled, -WIRE_SAMPLE_SCALE, WIRE_SAMPLE_SCALE - 1, out=scaled)
+        np.copyto(wire, scaled, casting='unsafe')
+        self.send_multicast(wire)
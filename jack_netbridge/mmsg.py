@@ -0,0 +1,352 @@
+# mmsg.py
+# Batched UDP I/O through sendmmsg(2) / recvmmsg(2), with a plain socket fallback
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import socket
+import struct
+import sys
+
+import numpy as np
+
+# Every segment of a larger send starts with a header: sequence number of the
+# send and byte offset of the segment within it
+SEGMENT_HEADER = struct.Struct('!HH')
+# Largest payload per segment, leaving headroom below the 1472 bytes of UDP
+# payload a 1500 byte Ethernet MTU carries without IP fragmentation. Senders on
+# links with a smaller MTU use smaller segments.
+MAX_PAYLOAD_SIZE = 1400
+MAX_DATAGRAM_SIZE = SEGMENT_HEADER.size + MAX_PAYLOAD_SIZE
+# Segment offsets are 16 bit, which bounds the size of a single send_segmented() call
+MAX_SEGMENTED_SIZE = 0x10000
+# Segments of a send this many sequence numbers behind the current one are late
+# and dropped; anything further back means the transmitter restarted
+LATE_SEQUENCE_WINDOW = 8
+# Number of datagrams handed to the kernel per sendmmsg call
+MAX_BATCH_SIZE = 32
+# Buffers a single queued datagram can be gathered from (segment header + payload)
+MAX_IOVECS = 2
+# recvmmsg(2) flag: block for the first datagram only, then return what is queued
+MSG_WAITFORONE = 0x10000
+# Linux UDP generic segmentation offload: the kernel splits one large send into datagrams
+SOL_UDP = getattr(socket, 'SOL_UDP', 17)
+UDP_SEGMENT = getattr(socket, 'UDP_SEGMENT', 103)
+# Most segments the kernel accepts in a single UDP_SEGMENT send (UDP_MAX_SEGMENTS)
+UDP_MAX_SEGMENTS = 64
+# A UDP_SEGMENT send as a whole also has to fit the IPv4 UDP payload limit
+MAX_UDP_PAYLOAD_SIZE = 65507
+
+
+class Iovec(ctypes.Structure):
+    _fields_ = [
+        ('iov_base', ctypes.c_void_p),
+        ('iov_len', ctypes.c_size_t),
+    ]
+
+
+class Msghdr(ctypes.Structure):
+    _fields_ = [
+        ('msg_name', ctypes.c_void_p),
+        ('msg_namelen', ctypes.c_uint32),
+        ('msg_iov', ctypes.POINTER(Iovec)),
+        ('msg_iovlen', ctypes.c_size_t),
+        ('msg_control', ctypes.c_void_p),
+        ('msg_controllen', ctypes.c_size_t),
+        ('msg_flags', ctypes.c_int),
+    ]
+
+
+class Mmsghdr(ctypes.Structure):
+    _fields_ = [
+        ('msg_hdr', Msghdr),
+        ('msg_len', ctypes.c_uint),
+    ]
+
+
+class SockaddrIn(ctypes.Structure):
+    _fields_ = [
+        ('sin_family', ctypes.c_ushort),
+        ('sin_port', ctypes.c_ushort),
+        ('sin_addr', ctypes.c_ubyte * 4),
+        ('sin_zero', ctypes.c_ubyte * 8),
+    ]
+
+    @classmethod
+    def from_address_tuple(cls, addr):
+        host, port = addr
+        sockaddr = cls()
+        sockaddr.sin_family = socket.AF_INET
+        sockaddr.sin_port = socket.htons(port)
+        sockaddr.sin_addr[:] = socket.inet_aton(host)
+        return sockaddr
+
+
+def _load_libc():
+    # sendmmsg/recvmmsg are Linux specific; anything else uses the socket module
+    if not sys.platform.startswith('linux'):
+        return None
+
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        sendmmsg = libc.sendmmsg
+        recvmmsg = libc.recvmmsg
+    except (OSError, AttributeError):
+        return None
+
+    sendmmsg.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_uint, ctypes.c_int]
+    sendmmsg.restype = ctypes.c_int
+    recvmmsg.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_uint, ctypes.c_int, ctypes.c_void_p]
+    recvmmsg.restype = ctypes.c_int
+    return libc
+
+
+libc = _load_libc()
+
+
+class BatchedMulticastSender:
+    """Collect datagrams and send them with as few syscalls as possible.
+
+    Packets are queued with `queue()` and handed to the kernel by `flush()`
+    in a single sendmmsg(2) call. Falls back to one sendmsg() per packet where
+    sendmmsg is not available.
+    """
+
+    def __init__(self, sock: socket.socket, addr: tuple, payload_size: int = MAX_PAYLOAD_SIZE):
+        if not 0 < payload_size <= MAX_PAYLOAD_SIZE:
+            raise ValueError(f"Segment payload size must be between 1 and {MAX_PAYLOAD_SIZE}, got {payload_size}")
+        self.sock = sock
+        self.addr = addr
+        self.payload_size = payload_size
+        datagram_size = SEGMENT_HEADER.size + payload_size
+        self.max_gso_segments = min(UDP_MAX_SEGMENTS, MAX_UDP_PAYLOAD_SIZE // datagram_size)
+        # Queued datagrams; also keeps the memory the iovecs point to alive until flushed
+        self.queued = []
+        self.seq = 0
+        self._sockaddr = SockaddrIn.from_address_tuple(addr)
+        self.gso = sys.platform.startswith('linux')
+        self._gso_ancdata = [(SOL_UDP, UDP_SEGMENT, struct.pack('=H', datagram_size))]
+
+        # Message headers, iovecs and segment headers for a full batch are allocated
+        # and linked once; queuing a datagram only fills in addresses and lengths
+        self._msgs = (Mmsghdr * MAX_BATCH_SIZE)()
+        self._iovs = (Iovec * (MAX_BATCH_SIZE * MAX_IOVECS))()
+        self._headers = (ctypes.c_char * (SEGMENT_HEADER.size * max(MAX_BATCH_SIZE, UDP_MAX_SEGMENTS)))()
+        self._header_view = memoryview(self._headers).cast('B')
+        for i in range(MAX_BATCH_SIZE):
+            hdr = self._msgs[i].msg_hdr
+            hdr.msg_name = ctypes.addressof(self._sockaddr)
+            hdr.msg_namelen = ctypes.sizeof(self._sockaddr)
+            hdr.msg_iov = ctypes.pointer(self._iovs[i * MAX_IOVECS])
+
+    def send_segmented(self, data) -> None:
+        """Send `data` as consecutive segments of at most `payload_size` bytes.
+
+        Each segment is prefixed with SEGMENT_HEADER so the receiver can
+        reassemble it. Uses a single UDP_SEGMENT sendmsg() where the kernel
+        supports it, otherwise queues the segments for a batched `flush()`.
+        """
+        data = memoryview(data).cast('B')
+        if len(data) > MAX_SEGMENTED_SIZE:
+            raise ValueError(f"Cannot send more than {MAX_SEGMENTED_SIZE} bytes at once, got {len(data)}")
+        seq = self.seq
+        self.seq = (seq + 1) & 0xFFFF
+
+        payload_size = self.payload_size
+        # The kernel concatenates the buffers and cuts them every header + payload_size
+        # bytes, i.e. exactly at the header boundaries
+        if self.gso and payload_size < len(data) <= payload_size * self.max_gso_segments:
+            # Headers are packed into the preallocated slots; the buffers are only slices
+            buffers = []
+            for header_offset, offset in enumerate(range(0, len(data), payload_size)):
+                header_offset *= SEGMENT_HEADER.size
+                SEGMENT_HEADER.pack_into(self._headers, header_offset, seq, offset)
+                buffers.append(self._header_view[header_offset:header_offset + SEGMENT_HEADER.size])
+                buffers.append(data[offset:offset + payload_size])
+            try:
+                self.sock.sendmsg(buffers, self._gso_ancdata, 0, self.addr)
+                return
+            except OSError as e:
+                if e.errno not in (errno.EINVAL, errno.ENOPROTOOPT, errno.EIO, errno.EOPNOTSUPP):
+                    raise
+                # Kernel or device without UDP GSO, do not try again
+                self.gso = False
+
+        if libc is None:
+            for offset in range(0, len(data), payload_size):
+                self.queue(SEGMENT_HEADER.pack(seq, offset), data[offset:offset + payload_size])
+        else:
+            # Point the iovecs straight at the preallocated headers and into data
+            base = np.frombuffer(data, dtype=np.uint8).ctypes.data
+            headers = ctypes.addressof(self._headers)
+            for offset in range(0, len(data), payload_size):
+                header_offset = len(self.queued) * SEGMENT_HEADER.size
+                SEGMENT_HEADER.pack_into(self._headers, header_offset, seq, offset)
+                self._set_iovecs(len(self.queued), (
+                    (headers + header_offset, SEGMENT_HEADER.size),
+                    (base + offset, min(payload_size, len(data) - offset)),
+                ))
+                self._append(data)
+        self.flush()
+
+    def queue(self, *buffers) -> None:
+        """Queue one datagram, gathered from up to MAX_IOVECS buffers."""
+        if len(buffers) > MAX_IOVECS:
+            raise ValueError(f"A datagram can be gathered from at most {MAX_IOVECS} buffers")
+
+        if libc is not None:
+            views = [np.frombuffer(buf, dtype=np.uint8) for buf in buffers]
+            self._set_iovecs(len(self.queued), [(view.ctypes.data, view.nbytes) for view in views])
+        self._append(buffers)
+
+    def flush(self) -> None:
+        if not self.queued:
+            return
+
+        try:
+            if libc is None:
+                for buffers in self.queued:
+                    self.sock.sendmsg(buffers, [], 0, self.addr)
+            else:
+                self._sendmmsg(len(self.queued))
+        finally:
+            # Datagrams that failed are dropped, not sent again with the next batch
+            self.queued.clear()
+
+    def _append(self, owner) -> None:
+        self.queued.append(owner)
+        if len(self.queued) >= MAX_BATCH_SIZE:
+            self.flush()
+
+    def _set_iovecs(self, index: int, iovecs) -> None:
+        self._msgs[index].msg_hdr.msg_iovlen = len(iovecs)
+        for i, (address, length) in enumerate(iovecs):
+            iov = self._iovs[index * MAX_IOVECS + i]
+            iov.iov_base = address
+            iov.iov_len = length
+
+    def _sendmmsg(self, count: int) -> None:
+        # sendmmsg may send fewer messages than requested; resume after the last one sent
+        sent = 0
+        while sent < count:
+            result = libc.sendmmsg(self.sock.fileno(), ctypes.addressof(self._msgs[sent]), count - sent, 0)
+            if result < 0:
+                err = ctypes.get_errno()
+                raise OSError(err, os.strerror(err))
+            sent += result
+
+
+class BatchedMulticastReceiver:
+    """Drain up to `count` datagrams per recvmmsg(2) call.
+
+    All buffers and message headers are allocated once. The memoryviews
+    yielded by `recv()` point into those buffers and are only valid until
+    the next call. Falls back to recv_into() where recvmmsg is not available.
+    """
+
+    def __init__(self, sock: socket.socket, bufsize: int, count: int = MAX_BATCH_SIZE):
+        self.sock = sock
+        self.count = count
+        self.buffers = [bytearray(bufsize) for _ in range(count)]
+        self.views = [memoryview(buf) for buf in self.buffers]
+        self._c_buffers = [(ctypes.c_char * bufsize).from_buffer(buf) for buf in self.buffers]
+        self._iovs = (Iovec * count)()
+        self._msgs = (Mmsghdr * count)()
+
+        for i, c_buf in enumerate(self._c_buffers):
+            self._iovs[i].iov_base = ctypes.addressof(c_buf)
+            self._iovs[i].iov_len = bufsize
+            self._msgs[i].msg_hdr.msg_iov = ctypes.pointer(self._iovs[i])
+            self._msgs[i].msg_hdr.msg_iovlen = 1
+
+        # A socket with a timeout is non-blocking at the OS level, so wait for
+        # readability ourselves before asking the kernel for a batch
+        self._poller = select.poll()
+        self._poller.register(sock, select.POLLIN)
+
+    def recv(self):
+        """Yield the payload of every datagram received in one call.
+
+        Raises socket.timeout if nothing arrived within the socket timeout.
+        """
+        timeout = self.sock.gettimeout()
+        if not self._poller.poll(None if timeout is None else timeout * 1000):
+            raise socket.timeout('timed out')
+
+        if libc is None:
+            nbytes = self.sock.recv_into(self.buffers[0])
+            yield self.views[0][:nbytes]
+            return
+
+        received = libc.recvmmsg(self.sock.fileno(), ctypes.addressof(self._msgs), self.count, MSG_WAITFORONE, None)
+        if received < 0:
+            err = ctypes.get_errno()
+            if err in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return
+            raise OSError(err, os.strerror(err))
+
+        for i in range(received):
+            yield self.views[i][:self._msgs[i].msg_len]
+
+
+class PeriodReassembler:
+    """Reassemble sends of `period_size` bytes made with `BatchedMulticastSender.send_segmented()`.
+
+    Feed every received datagram to `add()`. When it returns True, `period_data`
+    holds a complete period, valid until the next call.
+
+    The sender's segment size depends on its interface MTU and is learned from
+    the segments themselves: all but the last segment of a period are full size.
+    """
+
+    def __init__(self, period_size: int, segment_size: int = MAX_PAYLOAD_SIZE):
+        self.period_data = bytearray(period_size)
+        self.period_view = memoryview(self.period_data)
+        self.period_seq = None
+        # Bit i is set once segment i of the current period has arrived
+        self.received_mask = 0
+        self.set_segment_size(segment_size)
+
+    def set_segment_size(self, segment_size: int) -> None:
+        self.segment_size = segment_size
+        self.segment_count = -(-len(self.period_data) // segment_size)
+        self.complete_mask = (1 << self.segment_count) - 1
+        self.received_mask = 0
+
+    def add(self, datagram) -> bool:
+        if len(datagram) < SEGMENT_HEADER.size:
+            return False
+        seq, offset = SEGMENT_HEADER.unpack_from(datagram)
+        payload = datagram[SEGMENT_HEADER.size:]
+
+        if seq != self.period_seq:
+            # Drop late segments of a period that has already been superseded
+            if self.period_seq is not None and 0 < (self.period_seq - seq) & 0xFFFF <= LATE_SEQUENCE_WINDOW:
+                return False
+            # A new period starts; an incomplete previous one is dropped
+            self.period_seq = seq
+            self.received_mask = 0
+
+        end = offset + len(payload)
+        if not payload or end > len(self.period_data):
+            return False
+        if end < len(self.period_data) and len(payload) != self.segment_size:
+            # The sender uses a different segment size. Only a segment that opens
+            # a period may change it, so a stray datagram cannot wreck a period.
+            if self.received_mask:
+                return False
+            self.set_segment_size(len(payload))
+
+        # Only accept segments exactly where send_segmented() cuts them
+        index, remainder = divmod(offset, self.segment_size)
+        if remainder or len(payload) > self.segment_size:
+            return False
+
+        # Duplicates of a segment that already arrived are ignored
+        bit = 1 << index
+        if self.received_mask & bit:
+            return False
+        self.period_view[offset:end] = payload
+        self.received_mask |= bit
+        return self.received_mask == self.complete_mask
@@ -0,0 +1,132 @@
+import pytest
+
+from jack_netbridge.framing import (
+    MAX_MIDI_EVENT_SIZE,
+    MIDI_EVENT_HEADER,
+    pack_midi_events,
+    read_midi_event,
+    read_ringbuffer,
+    unpack_midi_events,
+)
+from jack_netbridge.mmsg import MAX_PAYLOAD_SIZE
+
+
+class FakeRingBuffer:
+    """Single-threaded stand-in for jack.RingBuffer.
+
+    `write()` can leave part of the data invisible to the reader, like the
+    write pointer of a real ringbuffer that is advanced in two steps when a
+    write wraps around the end.
+    """
+
+    def __init__(self, size):
+        self.data = bytearray(size)
+        self.read_pos = 0
+        self.write_pos = 0
+        self.visible_pos = 0
+
+    @property
+    def read_space(self):
+        return self.visible_pos - self.read_pos
+
+    @property
+    def read_buffers(self):
+        start = self.read_pos % len(self.data)
+        head = min(self.read_space, len(self.data) - start)
+        return memoryview(self.data)[start:start + head], memoryview(self.data)[:self.read_space - head]
+
+    def read_advance(self, size):
+        assert size <= self.read_space, "read past the write pointer"
+        self.read_pos += size
+
+    def write(self, data, visible=None):
+        assert self.write_pos + len(data) - self.read_pos <= len(self.data)
+        for byte in bytes(data):
+            self.data[self.write_pos % len(self.data)] = byte
+            self.write_pos += 1
+        self.visible_pos = self.write_pos if visible is None else self.visible_pos + visible
+
+    def publish(self):
+        self.visible_pos = self.write_pos
+
+
+@pytest.fixture
+def view():
+    return memoryview(bytearray(MAX_MIDI_EVENT_SIZE))
+
+
+def record(offset, event):
+    return MIDI_EVENT_HEADER.pack(len(event), offset) + bytes(event)
+
+
+def pack(events):
+    packet = memoryview(bytearray(MAX_PAYLOAD_SIZE))
+    datagrams = []
+    pack_midi_events(events, packet, lambda size: datagrams.append(bytes(packet[:size])))
+    return datagrams
+
+
+def test_pack_unpack_roundtrip():
+    events = [(i, bytes([0x90, 60, i % 128])) for i in range(600)]
+    datagrams = pack(events)
+
+    assert len(datagrams) == 3
+    assert all(len(datagram) <= MAX_PAYLOAD_SIZE for datagram in datagrams)
+    records = [rec for datagram in datagrams for rec in unpack_midi_events(datagram)]
+    assert records == [record(offset, event) for offset, event in events]
+
+
+def test_pack_sends_nothing_without_events():
+    assert pack([]) == []
+
+
+def test_pack_skips_oversized_events():
+    sysex = bytes([0xF0]) + bytes(MAX_MIDI_EVENT_SIZE) + bytes([0xF7])
+    datagrams = pack([(0, sysex), (5, bytes([0x80, 60, 0]))])
+    assert [rec for rec in unpack_midi_events(datagrams[0])] == [record(5, [0x80, 60, 0])]
+
+
+def test_unpack_drops_malformed_bytes():
+    # A data byte without a status byte, then a valid note on
+    datagram = record(0, [0x3C]) + record(1, [0x90, 60, 100])
+    assert list(unpack_midi_events(datagram)) == [record(1, [0x90, 60, 100])]
+
+
+def test_read_midi_event(view):
+    rb = FakeRingBuffer(64)
+    rb.write(record(7, [0x90, 60, 100]))
+    rb.write(record(9, [0x80, 60, 0]))
+
+    assert read_midi_event(rb, view) == (7, 3)
+    assert bytes(view[:3]) == bytes([0x90, 60, 100])
+    assert read_midi_event(rb, view) == (9, 3)
+    assert bytes(view[:3]) == bytes([0x80, 60, 0])
+    assert read_midi_event(rb, view) is None
+
+
+@pytest.mark.parametrize('visible', [1, MIDI_EVENT_HEADER.size, MIDI_EVENT_HEADER.size + 2])
+def test_read_midi_event_leaves_torn_record(view, visible):
+    rb = FakeRingBuffer(8)
+    # Move the pointers so the next record wraps around the end
+    rb.write(bytes(5))
+    rb.read_advance(5)
+
+    rb.write(record(7, [0x90, 60, 100]), visible=visible)
+    assert read_midi_event(rb, view) is None
+    assert rb.read_pos == 5
+
+    rb.publish()
+    assert read_midi_event(rb, view) == (7, 3)
+    assert bytes(view[:3]) == bytes([0x90, 60, 100])
+    assert rb.read_space == 0
+
+
+def test_read_ringbuffer_wraps(view):
+    rb = FakeRingBuffer(8)
+    rb.write(bytes(6))
+    rb.read_advance(6)
+    rb.write(b'abcde')
+
+    read_ringbuffer(rb, view, 5)
+    assert bytes(view[:5]) == b'abcde'
+    assert rb.read_space == 0
@@ -0,0 +1,72 @@
+import pytest
+
+from jack_netbridge import jack_netbridge
+from jack_netbridge.jack_netbridge import Manager
+
+CONFIG = """
+["synth:midi_in"]
+type = "MidiReceiver"
+multicast_group = "239.0.0.1"
+interface_name = "eth0"
+multicast_ttl = 2
+multicast_port = 4000
+
+["mic:out"]
+type = "AudioTransmitter"
+multicast_group = "239.0.0.2"
+interface_name = "eth1"
+multicast_ttl = 1
+multicast_port = 4001
+buffer_size = 512
+pin_to_numa_node = true
+
+["other:port"]
+type = "VideoTransmitter"
+multicast_group = "239.0.0.3"
+interface_name = "eth0"
+multicast_ttl = 2
+multicast_port = 4002
+"""
+
+
+class FakeClient:
+
+    def __init__(self, *args, **kwargs):
+        self.args = args
+        self.kwargs = kwargs
+        self.stop_event = None
+
+
+@pytest.fixture
+def manager(tmp_path, monkeypatch):
+    client_types = {name: type(name, (FakeClient,), {}) for name in jack_netbridge.CLIENT_TYPES}
+    monkeypatch.setattr(jack_netbridge, 'CLIENT_TYPES', client_types)
+    config_file = tmp_path / "jack_netbridge.toml"
+    config_file.write_text(CONFIG)
+    return Manager(str(config_file))
+
+
+def test_client_types_cover_all_clients():
+    assert set(jack_netbridge.CLIENT_TYPES) == {'MidiTransmitter', 'MidiReceiver', 'AudioTransmitter', 'AudioReceiver'}
+
+
+def test_load_config_dispatches_by_type(manager):
+    clients = manager.load_config()
+
+    assert type(clients["synth:midi_in"]).__name__ == 'MidiReceiver'
+    assert clients["synth:midi_in"].args == ("synth", "midi_in", "239.0.0.1", "eth0", 2, 4000, None)
+    assert clients["synth:midi_in"].kwargs == {'pin_to_numa_node': False}
+
+    assert type(clients["mic:out"]).__name__ == 'AudioTransmitter'
+    assert clients["mic:out"].args == ("mic", "out", "239.0.0.2", "eth1", 1, 4001, 512)
+    assert clients["mic:out"].kwargs == {'pin_to_numa_node': True}
+
+    assert all(client.stop_event is manager.stop_event for client in clients.values())
+
+
+def test_load_config_skips_unknown_types(manager, capsys):
+    clients = manager.load_config()
+
+    assert "other:port" not in clients
+    assert len(clients) == 2
+    assert "Unknown client type 'VideoTransmitter'" in capsys.readouterr().out
@@ -0,0 +1,210 @@
+import io
+
+import jack
+import numpy as np
+import pytest
+
+from jack_netbridge import lib
+from jack_netbridge.framing import MAX_MIDI_EVENT_SIZE, MIDI_EVENT_HEADER
+from jack_netbridge.lib import NetworkingSettingsHandler, RINGBUFFER_PERIODS, WIRE_SAMPLE_SCALE, WIRE_SAMPLE_WIDTH
+
+FRAMES = 256
+
+
+class FakePort:
+
+    def __init__(self, frames=FRAMES):
+        self.array = np.zeros(frames, dtype=np.float32)
+
+    def get_array(self):
+        return self.array
+
+
+def make_audio_transmitter(frames=FRAMES):
+    """An AudioTransmitter with the buffers setup_jack() creates, but no JACK client or socket."""
+    transmitter = lib.AudioTransmitter.__new__(lib.AudioTransmitter)
+    transmitter.buffer_size = frames
+    transmitter.input_port = FakePort(frames)
+    transmitter.scaled_samples = np.empty(frames, dtype=np.float32)
+    transmitter.wire_samples = np.empty(frames, dtype=lib.WIRE_SAMPLE_DTYPE)
+    transmitter.sent = []
+    transmitter.send_multicast = lambda data: transmitter.sent.append(bytes(data))
+    return transmitter
+
+
+def make_audio_receiver(frames=FRAMES):
+    """An AudioReceiver with the buffers setup_jack() creates, but no JACK client or socket."""
+    receiver = lib.AudioReceiver.__new__(lib.AudioReceiver)
+    receiver.buffer_size = frames
+    receiver.underruns = 0
+    receiver.ringbuffer_overruns = 0
+    receiver.port_overruns = 0
+    receiver.output_port = FakePort(frames)
+    receiver.audio_data = bytearray(frames * WIRE_SAMPLE_WIDTH)
+    receiver.audio_view = memoryview(receiver.audio_data)
+    receiver.audio_samples = np.frombuffer(receiver.audio_data, dtype=lib.WIRE_SAMPLE_DTYPE)
+    receiver.setup_ringbuffer(frames * WIRE_SAMPLE_WIDTH)
+    return receiver
+
+
+@pytest.fixture
+def sysfs(monkeypatch):
+    """Serve the sysfs files get_numa_cpus_by_interface_name() reads from a dict."""
+    files = {}
+
+    def fake_open(path, *args, **kwargs):
+        if path not in files:
+            raise FileNotFoundError(path)
+        return io.StringIO(files[path])
+
+    monkeypatch.setattr(lib, 'open', fake_open, raising=False)
+    return files
+
+
+@pytest.mark.parametrize('cpulist, cpus', [
+    ("0-3\n", {0, 1, 2, 3}),
+    ("5\n", {5}),
+    ("0-1,8-9,12\n", {0, 1, 8, 9, 12}),
+])
+def test_numa_cpus(sysfs, cpulist, cpus):
+    sysfs["/sys/class/net/eth0/device/numa_node"] = "1\n"
+    sysfs["/sys/devices/system/node/node1/cpulist"] = cpulist
+    assert NetworkingSettingsHandler.get_numa_cpus_by_interface_name('eth0') == cpus
+
+
+def test_numa_cpus_memory_only_node(sysfs):
+    sysfs["/sys/class/net/eth0/device/numa_node"] = "1\n"
+    sysfs["/sys/devices/system/node/node1/cpulist"] = "\n"
+    assert NetworkingSettingsHandler.get_numa_cpus_by_interface_name('eth0') is None
+
+
+def test_numa_cpus_without_numa_affinity(sysfs):
+    sysfs["/sys/class/net/eth0/device/numa_node"] = "-1\n"
+    assert NetworkingSettingsHandler.get_numa_cpus_by_interface_name('eth0') is None
+
+
+def test_numa_cpus_virtual_interface(sysfs):
+    assert NetworkingSettingsHandler.get_numa_cpus_by_interface_name('lo') is None
+
+
+def test_numa_cpus_malformed_cpulist(sysfs):
+    sysfs["/sys/class/net/eth0/device/numa_node"] = "0\n"
+    sysfs["/sys/devices/system/node/node0/cpulist"] = "0-x\n"
+    assert NetworkingSettingsHandler.get_numa_cpus_by_interface_name('eth0') is None
+
+
+def test_quantize_roundtrip():
+    transmitter = make_audio_transmitter()
+    receiver = make_audio_receiver()
+    samples = np.sin(np.linspace(0, 20, FRAMES, dtype=np.float32)) * np.float32(0.9)
+    transmitter.input_port.array[:] = samples
+
+    transmitter.process_callback(FRAMES)
+    assert len(transmitter.sent[0]) == FRAMES * WIRE_SAMPLE_WIDTH
+    assert receiver.push_to_ringbuffer(transmitter.sent[0])
+    receiver.process_callback(FRAMES)
+
+    assert np.abs(receiver.output_port.array - samples).max() <= 0.5 / WIRE_SAMPLE_SCALE
+
+
+def test_quantize_clips_full_scale():
+    transmitter = make_audio_transmitter(frames=4)
+    transmitter.input_port.array[:] = [1.0, -1.0, 2.0, -2.0]
+
+    transmitter.process_callback(4)
+
+    assert np.frombuffer(transmitter.sent[0], dtype=lib.WIRE_SAMPLE_DTYPE).tolist() == [32767, -32768, 32767, -32768]
+
+
+def test_ringbuffer_holds_all_periods():
+    receiver = make_audio_receiver()
+    period = bytes(FRAMES * WIRE_SAMPLE_WIDTH)
+    assert all(receiver.push_to_ringbuffer(period) for _ in range(RINGBUFFER_PERIODS))
+
+
+def quantized_period(value, frames=FRAMES):
+    return (np.arange(frames, dtype=lib.WIRE_SAMPLE_DTYPE) + value).tobytes()
+
+
+def test_audio_receiver_contiguous_and_wrapped_reads():
+    receiver = make_audio_receiver()
+    # Misalign the ringbuffer so periods keep wrapping around its end at different points
+    receiver.rb.write(bytes(300))
+    receiver.rb.read_advance(300)
+
+    wrapped = 0
+    for value in range(40):
+        assert receiver.push_to_ringbuffer(quantized_period(value))
+        first, second = receiver.rb.read_buffers
+        wrapped += len(first) < FRAMES * WIRE_SAMPLE_WIDTH
+
+        receiver.process_callback(FRAMES)
+
+        expected = np.frombuffer(quantized_period(value), dtype=lib.WIRE_SAMPLE_DTYPE) / WIRE_SAMPLE_SCALE
+        assert np.array_equal(receiver.output_port.array, expected.astype(np.float32))
+        assert receiver.rb.read_space == 0
+
+    assert wrapped
+    assert receiver.underruns == 0
+
+
+def test_audio_receiver_underrun_outputs_silence():
+    receiver = make_audio_receiver()
+    receiver.output_port.array[:] = 1.0
+    receiver.rb.write(quantized_period(1)[:100])
+
+    receiver.process_callback(FRAMES)
+
+    assert not receiver.output_port.array.any()
+    assert receiver.underruns == 1
+    # An incomplete period stays in the ringbuffer
+    assert receiver.rb.read_space == 100
+
+
+class FakeMidiPort:
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.events = []
+
+    def clear_buffer(self):
+        self.events = []
+
+    def write_midi_event(self, time, data):
+        if len(self.events) >= self.capacity:
+            raise jack.JackError("port buffer full")
+        self.events.append((time, bytes(data)))
+
+
+def make_midi_receiver(port_capacity):
+    """A MidiReceiver with the buffers setup_jack() creates, but no JACK client or socket."""
+    receiver = lib.MidiReceiver.__new__(lib.MidiReceiver)
+    receiver.buffer_size = FRAMES
+    receiver.ringbuffer_overruns = 0
+    receiver.port_overruns = 0
+    receiver.port_handle = FakeMidiPort(port_capacity)
+    receiver.midi_data = bytearray(MAX_MIDI_EVENT_SIZE)
+    receiver.midi_view = memoryview(receiver.midi_data)
+    receiver.setup_ringbuffer(4 * (MIDI_EVENT_HEADER.size + 3))
+    return receiver
+
+
+def test_midi_receiver_counts_overruns_per_thread():
+    receiver = make_midi_receiver(port_capacity=2)
+    records = [MIDI_EVENT_HEADER.pack(3, offset) + bytes([0x90, 60, 100]) for offset in (5, 3, 9)]
+    for record in records:
+        assert receiver.push_to_ringbuffer(record)
+    # Fill the ringbuffer up to the last byte, then overflow it
+    while receiver.push_to_ringbuffer(records[0]):
+        pass
+
+    assert receiver.ringbuffer_overruns == 1
+    assert receiver.port_overruns == 0
+
+    receiver.process_callback(FRAMES)
+
+    # Events are written in time order, an earlier offset is moved up
+    assert receiver.port_handle.events == [(5, bytes([0x90, 60, 100])), (5, bytes([0x90, 60, 100]))]
+    assert receiver.port_overruns > 0
+    assert receiver.ringbuffer_overruns == 1
+    assert receiver.rb.read_space == 0
@@ -0,0 +1,223 @@
+import socket
+
+import numpy as np
+import pytest
+
+from jack_netbridge import mmsg
+from jack_netbridge.mmsg import (
+    BatchedMulticastReceiver,
+    BatchedMulticastSender,
+    PeriodReassembler,
+    LATE_SEQUENCE_WINDOW,
+    MAX_DATAGRAM_SIZE,
+    MAX_PAYLOAD_SIZE,
+    MAX_SEGMENTED_SIZE,
+    SEGMENT_HEADER,
+)
+
+
+@pytest.fixture(params=['gso', 'sendmmsg', 'fallback'])
+def link(request, monkeypatch):
+    """A sender/receiver pair over loopback, using one of the three send paths."""
+    if request.param == 'fallback':
+        monkeypatch.setattr(mmsg, 'libc', None)
+    elif mmsg.libc is None:
+        pytest.skip("sendmmsg/recvmmsg not available")
+
+    rx_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    rx_sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024)
+    rx_sock.bind(('127.0.0.1', 0))
+    rx_sock.settimeout(0.2)
+    tx_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    sender = BatchedMulticastSender(tx_sock, rx_sock.getsockname())
+    sender.gso = request.param == 'gso'
+    receiver = BatchedMulticastReceiver(rx_sock, MAX_DATAGRAM_SIZE)
+    yield sender, receiver
+
+    tx_sock.close()
+    rx_sock.close()
+
+
+def receive_all(receiver):
+    datagrams = []
+    try:
+        while True:
+            datagrams.extend(bytes(data) for data in receiver.recv())
+    except socket.timeout:
+        pass
+    return datagrams
+
+
+def segments(seq, period_size, payload_size=MAX_PAYLOAD_SIZE):
+    """The datagrams send_segmented() produces for one period."""
+    return [
+        SEGMENT_HEADER.pack(seq, offset) + bytes([seq & 0xFF]) * min(payload_size, period_size - offset)
+        for offset in range(0, period_size, payload_size)
+    ]
+
+
+@pytest.mark.parametrize('period_size', [512, 4096, 60000, MAX_SEGMENTED_SIZE])
+def test_send_segmented_roundtrip(link, period_size):
+    sender, receiver = link
+    samples = np.arange(period_size // 2, dtype=np.int16)
+
+    sender.send_segmented(samples)
+    datagrams = receive_all(receiver)
+
+    assert len(datagrams) == -(-period_size // MAX_PAYLOAD_SIZE)
+    reassembler = PeriodReassembler(period_size)
+    assert [reassembler.add(data) for data in datagrams][-1]
+    assert np.array_equal(np.frombuffer(reassembler.period_data, dtype=np.int16), samples)
+
+
+@pytest.mark.parametrize('payload_size', [1368, 500])
+def test_send_segmented_small_mtu(link, payload_size):
+    tx_sock, addr = link[0].sock, link[0].addr
+    sender = BatchedMulticastSender(tx_sock, addr, payload_size)
+    sender.gso = link[0].gso
+    receiver = link[1]
+    samples = np.arange(4096, dtype=np.int16)
+
+    sender.send_segmented(samples)
+    datagrams = receive_all(receiver)
+
+    assert all(len(data) <= SEGMENT_HEADER.size + payload_size for data in datagrams)
+    # The receiver does not know the sender's MTU
+    reassembler = PeriodReassembler(samples.nbytes)
+    assert [reassembler.add(data) for data in datagrams][-1]
+    assert np.array_equal(np.frombuffer(reassembler.period_data, dtype=np.int16), samples)
+
+
+def test_sender_rejects_invalid_payload_size(link):
+    sender, receiver = link
+    with pytest.raises(ValueError):
+        BatchedMulticastSender(sender.sock, sender.addr, MAX_PAYLOAD_SIZE + 1)
+
+
+def test_flush_drops_failed_datagrams(link):
+    sender, receiver = link
+    sender.queue(b'lost')
+    sender.sock.close()
+    with pytest.raises(OSError):
+        sender.flush()
+    assert sender.queued == []
+
+
+def test_send_segmented_rejects_oversized_data(link):
+    sender, receiver = link
+    with pytest.raises(ValueError):
+        sender.send_segmented(bytes(MAX_SEGMENTED_SIZE + 1))
+
+
+def test_queue_gathers_buffers(link):
+    sender, receiver = link
+    # More than one batch, so flush() also runs from queue()
+    for i in range(mmsg.MAX_BATCH_SIZE + 8):
+        sender.queue(b'ab', bytes([i]))
+    sender.flush()
+
+    assert receive_all(receiver) == [b'ab' + bytes([i]) for i in range(mmsg.MAX_BATCH_SIZE + 8)]
+
+
+def test_reassembler_in_order():
+    reassembler = PeriodReassembler(4096)
+    assert [reassembler.add(data) for data in segments(1, 4096)] == [False, False, True]
+    assert reassembler.period_data == bytes([1]) * 4096
+
+
+def test_reassembler_out_of_order():
+    reassembler = PeriodReassembler(4096)
+    datagrams = segments(1, 4096)
+    assert [reassembler.add(data) for data in reversed(datagrams)] == [False, False, True]
+
+
+def test_reassembler_drops_period_with_lost_segment():
+    reassembler = PeriodReassembler(4096)
+    first = segments(1, 4096)
+    assert not reassembler.add(first[0])
+    assert not reassembler.add(first[2])
+    # The next period replaces the incomplete one
+    assert [reassembler.add(data) for data in segments(2, 4096)] == [False, False, True]
+    assert reassembler.period_data == bytes([2]) * 4096
+
+
+def test_reassembler_ignores_duplicates():
+    reassembler = PeriodReassembler(4096)
+    datagrams = segments(1, 4096)
+    assert not reassembler.add(datagrams[0])
+    assert not reassembler.add(datagrams[0])
+    # Segment 0 twice plus segment 2 adds up to the period size, but segment 1 is missing
+    assert not reassembler.add(datagrams[2])
+    assert reassembler.add(datagrams[1])
+    # A duplicate after completion does not complete the period again
+    assert not reassembler.add(datagrams[1])
+
+
+def test_reassembler_ignores_malformed_segments():
+    reassembler = PeriodReassembler(4096)
+    datagrams = segments(1, 4096)
+    assert not reassembler.add(b'\x00')
+    assert not reassembler.add(datagrams[0])
+    # Not on a segment boundary
+    assert not reassembler.add(SEGMENT_HEADER.pack(1, 100) + bytes(MAX_PAYLOAD_SIZE))
+    # Beyond the end of the period
+    assert not reassembler.add(SEGMENT_HEADER.pack(1, 4000) + bytes(MAX_PAYLOAD_SIZE))
+    # Wrong length for the segment
+    assert not reassembler.add(SEGMENT_HEADER.pack(1, 1400) + bytes(10))
+    assert not reassembler.add(SEGMENT_HEADER.pack(1, 1400) + bytes(2000))
+    assert [reassembler.add(data) for data in datagrams[1:]] == [False, True]
+    assert reassembler.period_data == bytes([1]) * 4096
+
+
+def test_reassembler_learns_segment_size():
+    reassembler = PeriodReassembler(4096)
+    assert [reassembler.add(data) for data in segments(1, 4096, 500)][-1]
+    assert reassembler.segment_size == 500
+    assert [reassembler.add(data) for data in segments(2, 4096, 500)] == [False] * 8 + [True]
+
+    # A transmitter restarted on an interface with a different MTU
+    assert [reassembler.add(data) for data in segments(100, 4096)] == [False, False, True]
+    assert reassembler.segment_size == MAX_PAYLOAD_SIZE
+
+
+def test_reassembler_keeps_segment_size_within_a_period():
+    reassembler = PeriodReassembler(4096)
+    datagrams = segments(1, 4096)
+    assert not reassembler.add(datagrams[0])
+    assert not reassembler.add(SEGMENT_HEADER.pack(1, 1000) + bytes(500))
+    assert [reassembler.add(data) for data in datagrams[1:]] == [False, True]
+
+
+def test_reassembler_drops_late_segments():
+    reassembler = PeriodReassembler(4096)
+    late = segments(1, 4096)
+    assert not reassembler.add(late[0])
+    for data in segments(2, 4096):
+        reassembler.add(data)
+
+    # Segments of the superseded period do not start a new one
+    assert not reassembler.add(late[1])
+    assert not reassembler.add(late[2])
+    assert reassembler.period_seq == 2
+
+
+def test_reassembler_accepts_sequence_reset():
+    reassembler = PeriodReassembler(4096)
+    for seq in range(20000):
+        for data in segments(seq, 4096):
+            reassembler.add(data)
+
+    # A restarted transmitter starts counting from 0 again
+    completed = sum(reassembler.add(data) for seq in range(100) for data in segments(seq, 4096))
+    assert completed == 100
+
+
+def test_reassembler_sequence_wraparound():
+    reassembler = PeriodReassembler(4096)
+    completed = sum(
+        reassembler.add(data)
+        for seq in range(0xFFFF - LATE_SEQUENCE_WINDOW, 0xFFFF + LATE_SEQUENCE_WINDOW)
+        for data in segments(seq & 0xFFFF, 4096)
+    )
+    assert completed == 2 * LATE_SEQUENCE_WINDOW